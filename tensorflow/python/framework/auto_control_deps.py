@@ -27,7 +27,6 @@ from tensorflow.python.ops import control_flow_ops
 from tensorflow.python.ops import control_flow_util
 from tensorflow.python.ops import tensor_array_ops
 from tensorflow.python.util import nest
-from tensorflow.python.util import object_identity
 from tensorflow.python.util import tf_decorator
 
 # LINT.IfChange
@@ -92,9 +91,10 @@ _ORDER_INSENSITIVE_STATEFUL_OPS = [
 ]
 # LINT.ThenChange(//tensorflow/core/grappler/optimizers/function_optimizer.cc)
 
-_ALL_BLACKLISTED_OPS = (
-    set(ASYNC_STATEFUL_OPS) | set(LEGACY_RANDOM_OPS)
-    | set(_ORDER_INSENSITIVE_STATEFUL_OPS))
+_ALL_BLACKLISTED_OPS = frozenset(
+    ASYNC_STATEFUL_OPS + LEGACY_RANDOM_OPS + _ORDER_INSENSITIVE_STATEFUL_OPS)
+
+_RESOURCE_DTYPE = dtypes_module.resource
 
 
 def op_is_stateful(op):
@@ -119,8 +119,10 @@ class AutomaticControlDependencies(object):
   """
 
   def __init__(self):
-    self._returned_tensors = object_identity.ObjectIdentitySet()
-    self.ops_which_must_run = set()
+    # Maps id(tensor) to tensor, so returned tensors are tracked by identity.
+    self._returned_tensors = {}
+    # Ops which must run, in the order they were found.
+    self.ops_which_must_run = []
 
   def mark_as_return(self, tensor):
     """Acts like identity but marks the `Tensor` as a return value.
@@ -140,29 +142,35 @@ class AutomaticControlDependencies(object):
     Returns:
       a copy of the `Tensor`.
     """
-    if isinstance(tensor, ops.IndexedSlices):
-      values = array_ops.identity(tensor.values)
-      indices = array_ops.identity(tensor.indices)
-      self._returned_tensors.add(indices)
-      self._returned_tensors.add(values)
-      return ops.IndexedSlices(values, indices, dense_shape=tensor.dense_shape)
-    elif isinstance(tensor, sparse_tensor.SparseTensor):
-      values = array_ops.identity(tensor.values)
-      indices = array_ops.identity(tensor.indices)
-      self._returned_tensors.add(indices)
-      self._returned_tensors.add(values)
-      return sparse_tensor.SparseTensor(
-          indices, values, dense_shape=tensor.dense_shape)
-    elif isinstance(tensor, tensor_array_ops.TensorArray):
-      flow = array_ops.identity(tensor.flow)
-      self._returned_tensors.add(flow)
-      return tensor_array_ops.build_ta_with_new_flow(tensor, flow)
+    # Dense tensors are by far the most common return values, so only check for
+    # composite types when the type isn't exactly `Tensor`.
+    if type(tensor) is not ops.Tensor:  # pylint: disable=unidiomatic-typecheck
+      # dense_shape is passed through unchanged: an identity would hide its
+      # constant value and with it the static shape of the result.
+      if isinstance(tensor, ops.IndexedSlices):
+        values = array_ops.identity(tensor.values)
+        indices = array_ops.identity(tensor.indices)
+        self._returned_tensors[id(indices)] = indices
+        self._returned_tensors[id(values)] = values
+        return ops.IndexedSlices(
+            values, indices, dense_shape=tensor.dense_shape)
+      elif isinstance(tensor, sparse_tensor.SparseTensor):
+        values = array_ops.identity(tensor.values)
+        indices = array_ops.identity(tensor.indices)
+        self._returned_tensors[id(indices)] = indices
+        self._returned_tensors[id(values)] = values
+        return sparse_tensor.SparseTensor(
+            indices, values, dense_shape=tensor.dense_shape)
+      elif isinstance(tensor, tensor_array_ops.TensorArray):
+        flow = array_ops.identity(tensor.flow)
+        self._returned_tensors[id(flow)] = flow
+        return tensor_array_ops.build_ta_with_new_flow(tensor, flow)
     # We want to make the return values depend on the stateful operations, but
     # we don't want to introduce a cycle, so we make the return value the result
     # of a new identity operation that the stateful operations definitely don't
     # depend on.
     tensor = array_ops.identity(tensor)
-    self._returned_tensors.add(tensor)
+    self._returned_tensors[id(tensor)] = tensor
     return tensor
 
   def __enter__(self):
@@ -175,10 +183,11 @@ class AutomaticControlDependencies(object):
     # probably other things as well).
     self._graph = ops.get_default_graph()
     self._graph._add_control_dependencies = True  # pylint: disable=protected-access
-    self._n_operations = len(self._graph.get_operations())
+    # Ops created in this scope get ids greater than the current last id.
+    self._last_op_id = self._graph._last_id  # pylint: disable=protected-access
     return self
 
-  def _process_switch(self, switch_op, ops_which_must_run,
+  def _process_switch(self, switch_op, add_op_which_must_run,
                       last_op_using_resource_tensor, merge_for_resource):
     """Processes a switch node for a resource input.
 
@@ -208,37 +217,43 @@ class AutomaticControlDependencies(object):
 
     Args:
       switch_op: the switch op to be processed
-      ops_which_must_run: the set of ops which must run
+      add_op_which_must_run: callable which marks an op as one which must run
       last_op_using_resource_tensor: map from resource tensor to last op using
         it
       merge_for_resource: map from resource tensor to merge which must follow
         all usages of it.
     """
+    # Walk up the chain of resource switches feeding this one, so that they can
+    # be processed outermost first without recursing once per nesting level.
+    switch_ops = [switch_op]
     inp = switch_op.inputs[0]
-    input_id = ops.tensor_id(inp)
-    if inp.dtype == dtypes_module.resource and inp.op.type == "Switch":
-      self._process_switch(inp.op, ops_which_must_run,
-                           last_op_using_resource_tensor, merge_for_resource)
-    output = switch_op.outputs[0]
-    output_id = ops.tensor_id(output)
-    if output_id in merge_for_resource:
-      return
-    new_merge = control_flow_ops.merge(switch_op.outputs,
-                                       name="artificial_merge")
-    new_merge[0].op._control_flow_context = (  # pylint: disable=protected-access
-        switch_op._control_flow_context.outer_context)  # pylint: disable=protected-access
-    # Ensures the merge always runs
-    ops_which_must_run.add(new_merge[0].op)
-    if input_id in last_op_using_resource_tensor:
-      # Ensures the switch executes after the previous op using the resource.
-      switch_op._add_control_input(last_op_using_resource_tensor[input_id])  # pylint: disable=protected-access
-    # Ensure the next op outside the cond happens after the merge.
-    last_op_using_resource_tensor[input_id] = new_merge[0].op
-    if input_id in merge_for_resource:
-      merge_for_resource[input_id]._add_control_input(new_merge[0].op)  # pylint: disable=protected-access
-    for o in switch_op.outputs:
-      # Ensures the merge will execute after all ops inside the cond
-      merge_for_resource[ops.tensor_id(o)] = new_merge[0].op
+    while inp.dtype == _RESOURCE_DTYPE and inp.op.type == "Switch":
+      switch_ops.append(inp.op)
+      inp = inp.op.inputs[0]
+
+    for switch in reversed(switch_ops):
+      inp = switch.inputs[0]
+      input_id = ops.tensor_id(inp)
+      output = switch.outputs[0]
+      output_id = ops.tensor_id(output)
+      if output_id in merge_for_resource:
+        continue
+      new_merge = control_flow_ops.merge(switch.outputs,
+                                         name="artificial_merge")
+      new_merge[0].op._control_flow_context = (  # pylint: disable=protected-access
+          switch._control_flow_context.outer_context)  # pylint: disable=protected-access
+      # Ensures the merge always runs
+      add_op_which_must_run(new_merge[0].op)
+      if input_id in last_op_using_resource_tensor:
+        # Ensures the switch executes after the previous op using the resource.
+        switch._add_control_input(last_op_using_resource_tensor[input_id])  # pylint: disable=protected-access
+      # Ensure the next op outside the cond happens after the merge.
+      last_op_using_resource_tensor[input_id] = new_merge[0].op
+      if input_id in merge_for_resource:
+        merge_for_resource[input_id]._add_control_input(new_merge[0].op)  # pylint: disable=protected-access
+      for o in switch.outputs:
+        # Ensures the merge will execute after all ops inside the cond
+        merge_for_resource[ops.tensor_id(o)] = new_merge[0].op
 
   def __exit__(self, unused_type, unused_value, unused_traceback):
     if context.executing_eagerly():
@@ -254,16 +269,37 @@ class AutomaticControlDependencies(object):
       self._graph._add_control_dependencies = outer_val
     else:
       self._graph._add_control_dependencies = False
+
+    # If no ops were created in this scope there is nothing to serialize, and
+    # nothing can have been marked as a return value (mark_as_return always
+    # creates an op).
+    if self._graph._last_id == self._last_op_id:
+      return
     # pylint: enable=protected-access
 
     # map from resource tensor to the last op which used it
     last_op_using_resource_tensor = {}
-    # set of conditional and loop exits
-    ops_which_must_run = set()
+    # conditional and loop exits, in the order they were found, and the same
+    # ops as a set for deduplication
+    ops_which_must_run = []
+    ops_which_must_run_set = set()
     # merge which must depend on ops which use this resource
     merge_for_resource = {}
 
-    new_operations = self._graph.get_operations()[self._n_operations:]
+    def add_op_which_must_run(o):
+      if o in ops_which_must_run_set:
+        return
+      ops_which_must_run_set.add(o)
+      ops_which_must_run.append(o)
+
+    # Look up only the ops created in this scope rather than copying the list of
+    # every op in the graph.
+    nodes_by_id = self._graph._nodes_by_id  # pylint: disable=protected-access
+    new_operations = [
+        nodes_by_id[op_id]
+        for op_id in range(self._last_op_id + 1, self._graph._last_id + 1)  # pylint: disable=protected-access
+        if op_id in nodes_by_id
+    ]
 
     # Ensures that uses of resource tensors get serialized properly and all
     # execute. This is done by keeping a map from resource tensor to the last op
@@ -293,75 +329,112 @@ class AutomaticControlDependencies(object):
     # TODO(apassos): serialize non-resource-taking stateful ops as well, and
     # test that it works. Support while loops. Support init_scope escaping from
     # this.
+    blacklisted_ops = _ALL_BLACKLISTED_OPS
+    # pylint: disable=protected-access
+    registered_ops = self._graph._registered_ops
+    tensor_id = ops.tensor_id
+    resource_dtype = _RESOURCE_DTYPE
+    # map from control flow context to whether it is inside a while loop
+    in_while_loop_by_ctx = {}
     for op in new_operations:
+      ctx = op._control_flow_context
       # TODO(apassos) make this code safely support while loops.
-      if control_flow_util.IsInWhileLoop(op):
-        continue
-      control_inputs = set()
+      if ctx is not None:
+        in_while_loop = in_while_loop_by_ctx.get(ctx)
+        if in_while_loop is None:
+          in_while_loop = (
+              control_flow_util.GetContainingWhileContext(ctx) is not None)
+          in_while_loop_by_ctx[ctx] = in_while_loop
+        if in_while_loop:
+          continue
+      # Cache attributes which are read several times per op; this loop runs
+      # over every op created in the scope.
+      op_type = op.type
+      inputs = op.inputs
+      stateful = op._is_stateful and op_type not in blacklisted_ops
       # Ensure stateful ops run
-      if (op.type not in self._graph._registered_ops  # pylint: disable=protected-access
-          or op_is_stateful(op)):
-        ops_which_must_run.add(op)
+      if op_type not in registered_ops or stateful:
+        add_op_which_must_run(op)
       # Ignore switches (they're handled separately)
-      if op.type == "Switch" and op.inputs[0].dtype == dtypes_module.resource:
+      if op_type == "Switch" and inputs[0].dtype == resource_dtype:
         continue
       # Make merges trigger all other computation which must run
-      if op.type == "Merge":
+      if op_type == "Merge":
+        op._add_control_inputs(ops_which_must_run)
+        # ops_which_must_run only holds ops added since the previous merge, so
+        # each op's inputs are scanned once.
         for o in ops_which_must_run:
-          op._add_control_input(o)  # pylint: disable=protected-access
           for inp in o.inputs:
-            input_id = ops.tensor_id(inp)
+            input_id = tensor_id(inp)
             if input_id in last_op_using_resource_tensor:
               last_op_using_resource_tensor[input_id] = op
-        ops_which_must_run = set([op])
+        del ops_which_must_run[:]
+        ops_which_must_run_set.clear()
+        add_op_which_must_run(op)
         continue
 
-      resource_inputs = set()
+      control_inputs = set()
+      control_inputs_add = control_inputs.add
+      # Ops rarely have more than a few resource inputs, so a list is cheaper to
+      # build and scan than a set.
+      resource_inputs = []
       # Check for any resource inputs. If we find any, we update control_inputs
       # and last_op_using_resource_tensor.
-      for inp in op.inputs:
-        if inp.dtype != dtypes_module.resource:
+      for inp in inputs:
+        if inp.dtype != resource_dtype:
           continue
 
-        input_id = ops.tensor_id(inp)
+        input_id = tensor_id(inp)
 
         # If the op receives the same resource tensor twice as an input, we skip
         # to avoid the op getting a control dependency on itself.
         if input_id in resource_inputs:
           continue
 
-        resource_inputs.add(input_id)
+        resource_inputs.append(input_id)
         # Deal with switches, finally.
         if inp.op.type == "Switch":
-          self._process_switch(inp.op, ops_which_must_run,
+          self._process_switch(inp.op, add_op_which_must_run,
                                last_op_using_resource_tensor,
                                merge_for_resource)
         # Ensure uses of resources are serialized
         if input_id in last_op_using_resource_tensor:
-          if (last_op_using_resource_tensor[input_id]._control_flow_context  # pylint: disable=protected-access
-              is op._control_flow_context):  # pylint: disable=protected-access
-            control_inputs.add(last_op_using_resource_tensor[input_id])
+          if (last_op_using_resource_tensor[input_id]._control_flow_context
+              is ctx):
+            control_inputs_add(last_op_using_resource_tensor[input_id])
         # Ensure merges happen after the closing of a cond block
         if input_id in merge_for_resource:
-          merge_for_resource[input_id]._add_control_input(op)  # pylint: disable=protected-access
+          merge_for_resource[input_id]._add_control_input(op)
         last_op_using_resource_tensor[input_id] = op
 
-      if (op_is_stateful(op) and not resource_inputs
-          and op._control_flow_context is None):  # pylint: disable=protected-access
+      if stateful and not resource_inputs and ctx is None:
         if None in last_op_using_resource_tensor:
-          op._add_control_input(last_op_using_resource_tensor[None])  # pylint: disable=protected-access
+          op._add_control_input(last_op_using_resource_tensor[None])
         last_op_using_resource_tensor[None] = op
-      control_inputs = [c for c in control_inputs
-                        if c._control_flow_context is op._control_flow_context]  # pylint: disable=protected-access
-      op._add_control_inputs(control_inputs)  # pylint: disable=protected-access
+      # control_inputs only ever holds ops from this op's control flow context
+      # (checked above), so there is nothing left to filter.
+      if control_inputs:
+        op._add_control_inputs(control_inputs)
+    # pylint: enable=protected-access
 
     # Ensure all ops which must run do run
-    self.ops_which_must_run.update(ops_which_must_run)
-    for r in nest.flatten(list(self._returned_tensors), expand_composites=True):
-      if self.ops_which_must_run:
-        r.op._add_control_inputs(  # pylint: disable=protected-access
-            [o for o in self.ops_which_must_run
-             if o._control_flow_context is r.op._control_flow_context])  # pylint: disable=protected-access
+    already_must_run = set(self.ops_which_must_run)
+    self.ops_which_must_run.extend(
+        o for o in ops_which_must_run if o not in already_must_run)
+    if not self.ops_which_must_run:
+      return
+    # pylint: disable=protected-access
+    # Group the ops which must run by control flow context once, rather than
+    # filtering all of them again for every returned tensor.
+    ops_which_must_run_by_ctx = {}
+    for o in self.ops_which_must_run:
+      ops_which_must_run_by_ctx.setdefault(o._control_flow_context,
+                                           []).append(o)
+    for r in nest.flatten(list(self._returned_tensors.values()),
+                           expand_composites=True):
+      r.op._add_control_inputs(
+          ops_which_must_run_by_ctx.get(r.op._control_flow_context, ()))
+    # pylint: enable=protected-access
 
 
 def automatic_control_dependencies(f):
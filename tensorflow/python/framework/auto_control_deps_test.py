@@ -25,6 +25,7 @@ from tensorflow.python.framework import auto_control_deps as acd
 from tensorflow.python.framework import constant_op
 from tensorflow.python.framework import dtypes
 from tensorflow.python.framework import ops
+from tensorflow.python.framework import sparse_tensor
 from tensorflow.python.framework import tensor_spec
 from tensorflow.python.framework import test_util
 from tensorflow.python.keras.layers import core as keras_core
@@ -50,6 +51,29 @@ class AutomaticControlDependenciesTest(test.TestCase):
         val = c.mark_as_return(val)
       self.assertAllEqual(val.eval(), 4.0)
 
+  def testCompositeReturnValues(self):
+    with context.graph_mode(), self.cached_session():
+      v = resource_variable_ops.ResourceVariable(1.0)
+      self.evaluate(variables.global_variables_initializer())
+      with acd.AutomaticControlDependencies() as c:
+        v.assign(v + 1)
+        sp = sparse_tensor.SparseTensor(
+            indices=[[0, 0]], values=[1.0], dense_shape=[2, 2])
+        sp = c.mark_as_return(sp)
+        slices = ops.IndexedSlices(
+            values=array_ops.ones([1, 2]), indices=constant_op.constant([1]))
+        slices = c.mark_as_return(slices)
+      self.assertIsInstance(sp, sparse_tensor.SparseTensor)
+      self.assertIsInstance(slices, ops.IndexedSlices)
+      self.assertEqual(sp.shape.as_list(), [2, 2])
+      self.assertIsNone(slices.dense_shape)
+      # Fetch both together so the assign, which both returned values depend
+      # on, only runs once.
+      sp_values, slices_indices = self.evaluate([sp.values, slices.indices])
+      self.assertAllEqual(sp_values, [1.0])
+      self.assertAllEqual(slices_indices, [1])
+      self.assertAllEqual(v.read_value().eval(), 2.0)
+
   @test_util.run_v1_only("b/120545219")
   def testCondMustRun(self):
     with context.graph_mode(), self.cached_session():